@@ -0,0 +1,235 @@
+import argparse
+import hashlib
+from pathlib import Path
+import zipfile
+import zlib
+
+# members larger than this are hashed and probed in chunks rather than read into memory at once
+STREAM_THRESHOLD = 4 * 1024 * 1024
+
+# raised by zipfile when reading a corrupt, truncated, encrypted or oddly compressed member
+MEMBER_READ_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError, RuntimeError)
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+
+    with open(path, "rb", buffering=0) as f:
+        for b in iter(lambda: f.read(128 * 1024), b""):
+            h.update(b)
+
+    return h.hexdigest()
+
+
+def stream_hash(f, stats=None):
+    h = hashlib.sha1()
+
+    for b in iter(lambda: f.read(128 * 1024), b""):
+        h.update(b)
+
+        if stats is not None:
+            stats.count("bytes_inflated", len(b))
+
+    return h.hexdigest()
+
+
+class Limits:
+    # Per-member resource limits; None disables a limit
+
+    def __init__(self, max_member_size=None, max_ratio=None, max_pixels=None, stream_threshold=STREAM_THRESHOLD):
+        self.max_member_size = max_member_size
+        self.max_ratio = max_ratio
+        self.max_pixels = max_pixels
+        self.stream_threshold = stream_threshold
+
+    def check_member(self, info):
+        # returns the reason for rejecting the member, or None.
+        # zipfile never inflates past the declared file_size, so it can be trusted as a bound
+        if self.max_member_size is not None and info.file_size > self.max_member_size:
+            return f"size {info.file_size} exceeds {self.max_member_size}"
+
+        if self.max_ratio is not None and info.file_size > self.max_ratio * max(info.compress_size, 1):
+            return f"compression ratio {info.file_size / max(info.compress_size, 1):.0f} exceeds {self.max_ratio}"
+
+        return None
+
+    def check_image(self, size):
+        width, height = size
+
+        if self.max_pixels is not None and width * height > self.max_pixels:
+            return f"{width}x{height} pixels exceed {self.max_pixels}"
+
+        return None
+
+    def should_stream(self, info):
+        return self.stream_threshold is not None and info.file_size > self.stream_threshold
+
+
+def parse_size(value):
+    # "64M" -> 67108864
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+    try:
+        if value[-1:].upper() in units:
+            return int(float(value[:-1]) * units[value[-1].upper()])
+
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a size such as 512K or 64M, got {value!r}")
+
+
+def add_limit_arguments(parser):
+    parser.add_argument("--max-member-size", type=parse_size, metavar="SIZE", help="skip larger archive members")
+    parser.add_argument(
+        "--max-ratio", type=float, metavar="RATIO", help="skip members inflating to more than RATIO times their size"
+    )
+    parser.add_argument("--max-pixels", type=int, help="skip images with more pixels than this")
+    parser.add_argument(
+        "--stream-threshold",
+        type=parse_size,
+        default=STREAM_THRESHOLD,
+        metavar="SIZE",
+        help="hash and probe larger members in chunks instead of reading them whole",
+    )
+
+
+def limits_from_args(args):
+    return Limits(
+        max_member_size=args.max_member_size,
+        max_ratio=args.max_ratio,
+        max_pixels=args.max_pixels,
+        stream_threshold=args.stream_threshold,
+    )
+
+
+class Jar:
+    # An open JAR shared by all pipeline stages, so that the archive is opened, its central
+    # directory parsed and its hashes computed only once per process
+
+    def __init__(self, path, stats=None, limits=None):
+        self.path = Path(path)
+        self.stats = stats
+        self.limits = limits if limits is not None else Limits()
+
+        self.zip = zipfile.ZipFile(self.path, mode="r")
+        self._sha1 = None
+        self._member_sha1s = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    @property
+    def title(self):
+        return self.path.parent.name
+
+    @property
+    def filename(self):
+        return self.path.name
+
+    @property
+    def size(self):
+        return self.path.stat().st_size
+
+    @property
+    def sha1(self):
+        if self._sha1 is None:
+            self._sha1 = file_hash(self.path)
+
+        return self._sha1
+
+    def infolist(self):
+        return self.zip.infolist()
+
+    def open(self, filename):
+        return self.zip.open(filename, "r")
+
+    def read(self, filename):
+        with self.zip.open(filename, "r") as f:
+            data = f.read()
+
+        if self.stats is not None:
+            self.stats.count("bytes_inflated", len(data))
+
+        return data
+
+    def member_sha1(self, filename):
+        try:
+            return self._member_sha1s[filename]
+        except KeyError:
+            pass
+
+        with self.zip.open(filename, "r") as f:
+            sha1 = self._member_sha1s[filename] = stream_hash(f, stats=self.stats)
+
+        return sha1
+
+    def hash_member(self, filename, *hashes):
+        # single streaming pass computing the member SHA-1 and feeding any additional hashes
+        h = hashlib.sha1()
+
+        with self.zip.open(filename, "r") as f:
+            for b in iter(lambda: f.read(128 * 1024), b""):
+                h.update(b)
+
+                for other in hashes:
+                    other.update(b)
+
+                if self.stats is not None:
+                    self.stats.count("bytes_inflated", len(b))
+
+        sha1 = self._member_sha1s[filename] = h.hexdigest()
+        return sha1
+
+    def read_with_sha1(self, filename):
+        data = self.read(filename)
+
+        if filename not in self._member_sha1s:
+            self._member_sha1s[filename] = hashlib.sha1(data).hexdigest()
+
+        return data, self._member_sha1s[filename]
+
+
+def parse_shard(value):
+    # "K/N" -> (K, N), with 0 <= K < N
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected K/N, got {value!r}")
+
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be in range 0..N-1, got {value!r}")
+
+    return index, count
+
+
+def shard_of(sha1, count):
+    # deterministic across hosts and runs, unlike hash()
+    return int(sha1[:16], 16) % count
+
+
+def reject_member(db, jar, info, reason, stats):
+    stats.count("members_rejected")
+    stats.event(
+        "rejected",
+        "REJECTED",
+        jar.path,
+        info.filename,
+        reason,
+        jar=str(jar.path),
+        member=info.filename,
+        reason=reason,
+    )
+
+    db.add_rejected_member(
+        jar_sha1=jar.sha1,
+        filename=info.filename,
+        size=info.file_size,
+        compress_size=info.compress_size,
+        reason=reason,
+    )
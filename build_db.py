@@ -4,47 +4,21 @@ import argparse
 from datetime import datetime
 import hashlib
 import io
-import os
 from pathlib import Path
 import subprocess
 import sys
-import zipfile
 
 from PIL import Image
 
+from archive import MEMBER_READ_ERRORS, Jar, add_limit_arguments, limits_from_args, reject_member
 from db import DB, bad_resource_sha1s
+import instrumentation
 
 # TODO: proper dependency management
 sys.path.insert(0, "tools")
 import fishlabs_obfuscation
 from render_obj import render_obj
 
-parser = argparse.ArgumentParser()
-parser.add_argument("db", type=Path)
-parser.add_argument("jars", nargs="+", type=Path)
-args = parser.parse_args()
-
-db = DB(args.db)
-
-
-def file_hash(path):
-    h = hashlib.sha1()
-
-    with open(path, "rb", buffering=0) as f:
-        for b in iter(lambda: f.read(128 * 1024), b""):
-            h.update(b)
-
-    return h.hexdigest()
-
-
-def stream_hash(f):
-    h = hashlib.sha1()
-
-    for b in iter(lambda: f.read(128 * 1024), b""):
-        h.update(b)
-
-    return h.hexdigest()
-
 
 def read_manifest(z):
     manifest = {}
@@ -77,21 +51,24 @@ def read_manifest(z):
     return manifest
 
 
-all_bins = []
+RESOURCE_EXTS = {".BMP", ".MBAC", ".PNG"}
+
 
-for path in args.jars:
-    print("scan", path, file=sys.stderr)
+def ingest_jar(db, jar, stats):
+    stats.event("scan", "scan", jar.path, file=sys.stderr, path=str(jar.path))
 
-    title = Path(path).parts[-2]
-    if title == "Other":
-        continue
+    if jar.title == "Other":
+        stats.count("jars_skipped")
+        return False
 
-    size = os.stat(path).st_size
-    jar_hash = file_hash(path)
+    with stats.stage("hash_jar"):
+        jar_hash = jar.sha1
 
-    resource_exts = {".BMP", ".MBAC", ".PNG"}
+    # rejections are re-evaluated against the current limits on every ingest
+    db.clear_rejected_members(jar_hash)
 
-    with zipfile.ZipFile(path, mode="r") as z:
+    with stats.stage("scan_jar"):
+        z = jar.zip
         manifest = read_manifest(z)
         assert "MIDlet-Name" in manifest
 
@@ -110,9 +87,10 @@ for path in args.jars:
         min_timestamp = None
         max_timestamp = None
 
-        for info in z.infolist():
+        for info in jar.infolist():
             ext = Path(info.filename).suffix.upper()
             all_exts.add(ext)
+            stats.count("members_probed")
 
             timestamp = datetime(*info.date_time)
 
@@ -122,12 +100,10 @@ for path in args.jars:
             if max_timestamp is None or timestamp < max_timestamp:
                 max_timestamp = timestamp
 
-            if "MANIFEST.MF" not in info.filename.upper():
-                contents_size += info.file_size
+            is_contents = "MANIFEST.MF" not in info.filename.upper()
 
-                with z.open(info.filename, "r") as f:
-                    for b in iter(lambda: f.read(128 * 1024), b""):
-                        h.update(b)
+            if is_contents:
+                contents_size += info.file_size
 
             if ext == ".M3G":
                 detected_m3g += 1
@@ -136,21 +112,52 @@ for path in args.jars:
                 detected_mascot += 1
                 flags.add("MASCOT")
 
-            if not obfuscation and (ext == ".BMP" or ext == ".MBAC"):
-                with z.open(info.filename, "r") as f:
-                    all_data = f.read()
-
-                    detect = fishlabs_obfuscation.is_obfuscated(ext, all_data)
-                    if detect is True:
-                        obfuscation = True
+            reason = jar.limits.check_member(info)
+            if reason is not None:
+                reject_member(db, jar, info, reason, stats)
+                continue
+
+            try:
+                if jar.limits.should_stream(info):
+                    # too big to hold in memory; obfuscation detection and normalization need the
+                    # whole member, so large members are only hashed and probed as-is
+                    stats.count("members_streamed")
+                    sha1 = jar.hash_member(info.filename, *([h] if is_contents else []))
+                    all_data = None
+                else:
+                    # read each member once and derive everything from the same buffer
+                    all_data, sha1 = jar.read_with_sha1(info.filename)
+
+                    if is_contents:
+                        h.update(all_data)
+            except MEMBER_READ_ERRORS as ex:
+                reject_member(db, jar, info, f"unreadable: {ex!r}", stats)
+                continue
+
+            if all_data is not None and not obfuscation and (ext == ".BMP" or ext == ".MBAC"):
+                detect = fishlabs_obfuscation.is_obfuscated(ext, all_data)
+                if detect is True:
+                    obfuscation = True
 
             width, height = None, None
 
-            with z.open(info.filename, "r") as f:
+            with stats.stage("probe_image"):
                 try:
-                    data = fishlabs_obfuscation.normalize(f.read(), ext)
-                    img = Image.open(io.BytesIO(data))
+                    if all_data is not None:
+                        data = fishlabs_obfuscation.normalize(all_data, ext)
+                        img = Image.open(io.BytesIO(data))
+                    else:
+                        # Image.open only parses the header
+                        with jar.open(info.filename) as f:
+                            img = Image.open(f)
+
                     width, height = img.size
+                    stats.count("images_probed")
+
+                    reason = jar.limits.check_image(img.size)
+                    if reason is not None:
+                        # still listed as a resource, but previews will skip it
+                        reject_member(db, jar, info, reason, stats)
 
                     if widest_image is None or img.size[0] > widest_image[0]:
                         widest_image = (img.size[0], img.size[1], info.filename)
@@ -159,13 +166,21 @@ for path in args.jars:
                         tallest_image = (img.size[0], img.size[1], info.filename)
                 except IOError:
                     pass
+                except MEMBER_READ_ERRORS:
+                    pass
                 except Image.DecompressionBombError:
-                    print(info.filename, ": PIL.Image.DecompressionBombError", file=sys.stderr)
-
-            if ext in resource_exts:
-                with z.open(info.filename, "r") as f:
-                    sha1 = stream_hash(f)
+                    stats.count("decompression_bombs")
+                    stats.event(
+                        "decompression_bomb",
+                        info.filename,
+                        ": PIL.Image.DecompressionBombError",
+                        file=sys.stderr,
+                        jar=str(jar.path),
+                        member=info.filename,
+                    )
+                    reject_member(db, jar, info, "PIL.Image.DecompressionBombError", stats)
 
+            if ext in RESOURCE_EXTS:
                 if sha1 not in bad_resource_sha1s:
                     db.add_resource(
                         jar_sha1=jar_hash,
@@ -181,19 +196,29 @@ for path in args.jars:
         icon_path = manifest["MIDlet-1"].split(",")[1].strip()
         if icon_path[0] == "/":
             icon_path = icon_path[1:]
-        with z.open(icon_path, "r") as f:
-            icon_data = f.read()
+
+        icon_info = jar.zip.getinfo(icon_path)
+        icon_data = None
+        reason = jar.limits.check_member(icon_info)
+
+        if reason is not None:
+            reject_member(db, jar, icon_info, reason, stats)
+        else:
+            try:
+                icon_data = jar.read(icon_path)
+            except MEMBER_READ_ERRORS as ex:
+                reject_member(db, jar, icon_info, f"unreadable: {ex!r}", stats)
 
         contents_hash = h.hexdigest()
-        num_files = len(z.infolist())
+        num_files = len(jar.infolist())
 
-    name = Path(path).parts[-1]
     filetypes = " ".join(sorted(list(all_exts)))
 
+    stats.count("jars_ingested")
     db.add_jar(
-        title_id=db.get_title_id(title),
-        filename=name,
-        size=size,
+        title_id=db.get_title_id(jar.title),
+        filename=jar.filename,
+        size=jar.size,
         sha1=jar_hash,
         detected_fishlabs_obfuscation=obfuscation,
         detected_mascot=detected_mascot,
@@ -206,4 +231,27 @@ for path in args.jars:
         icon=icon_data,
     )
 
-db.close()
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db", type=Path)
+    parser.add_argument("jars", nargs="+", type=Path)
+    add_limit_arguments(parser)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    stats = instrumentation.from_args(args)
+    db = DB(args.db, stats=stats)
+    limits = limits_from_args(args)
+
+    for path in args.jars:
+        with Jar(path, stats=stats, limits=limits) as jar:
+            ingest_jar(db, jar, stats)
+
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import csv
+import re
 import sqlite3
 
 from pathlib import Path
@@ -13,6 +14,9 @@ bad_resource_sha1s = {
     hash for hash, comment in [line.split(",") for line in bad_resources_csv.split("\n")]
 }
 
+# in order of preference, see DB.create_search_index
+SEARCH_TOKENIZERS = ["trigram", "unicode61"]
+
 games_db = PlaintextSqlDb(Path(__file__).parent / "games.sql")
 
 
@@ -28,7 +32,8 @@ def upsert(conn, table, key, kv):
 
 
 class DB:
-    def __init__(self, path):
+    def __init__(self, path, stats=None):
+        self.stats = stats
         self.conn = sqlite3.connect(path)
         self.conn.row_factory = sqlite3.Row
 
@@ -86,20 +91,167 @@ class DB:
             """
         )
 
+        # archive members skipped because they exceeded resource limits or could not be read
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS rejected_member (
+                    jar_sha1 TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    size INTEGER,
+                    compress_size INTEGER,
+                    reason TEXT,
+                    PRIMARY KEY (jar_sha1, filename)
+                    )
+            """
+        )
+
+        c.execute("CREATE INDEX IF NOT EXISTS jar_title_id ON jar (title_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS resource_type_dimensions ON resource (type, width, height)")
+        c.execute("CREATE INDEX IF NOT EXISTS resource_size ON resource (size)")
+        c.execute("CREATE INDEX IF NOT EXISTS jar_resource_resource_sha1 ON jar_resource (resource_sha1)")
+
+        self.search_index = self.create_search_index()
+
         self.conn.commit()
 
+    def create_search_index(self):
+        # Full-text index over jar_resource rows, keyed by (jar_sha1, filename). The trigram tokenizer
+        # (SQLite >= 3.34) also accelerates substring LIKE queries; older SQLite versions fall back
+        # to the default tokenizer, or to no index at all without FTS5, and search() then filters
+        # the joined tables directly. Returns the tokenizer in use, or None.
+        c = self.conn.cursor()
+        c.execute("SELECT sql FROM sqlite_master WHERE name = 'resource_search'")
+        row = c.fetchone()
+
+        c.execute("SELECT 1 FROM sqlite_master WHERE name = 'resource_search_row'")
+        has_rows = c.fetchone() is not None
+
+        if row is not None and "jar_sha1" in row["sql"] and has_rows:
+            return "trigram" if "trigram" in row["sql"] else "unicode61"
+
+        if row is not None:
+            # index from before it was keyed by (jar_sha1, filename) with a rowid map
+            c.execute("DROP TABLE resource_search")
+
+        # FTS5 can only look rows up by rowid or full-text match, so the rowid of each JAR's index
+        # rows is kept in an ordinary table; reindexing a JAR would otherwise scan the whole index
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS resource_search_row (
+                    rowid INTEGER PRIMARY KEY,
+                    jar_sha1 TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    UNIQUE (jar_sha1, filename)
+                    )
+            """
+        )
+
+        for tokenizer in SEARCH_TOKENIZERS:
+            try:
+                c.execute(
+                    f"""
+                    CREATE VIRTUAL TABLE resource_search USING fts5 (
+                            filename,
+                            title,
+                            jar,
+                            jar_sha1 UNINDEXED,
+                            tokenize = '{tokenizer}'
+                            )
+                    """
+                )
+            except sqlite3.OperationalError:
+                continue
+
+            self.search_index = tokenizer
+            self.rebuild_search_index()
+            return tokenizer
+
+        return None
+
+    def _upsert(self, table, key, kv):
+        upsert(self.conn, table, key, kv)
+
+        if self.stats is not None:
+            self.stats.count("db_rows_written")
+
     def add_jar(self, **kwargs):
-        upsert(self.conn, "jar", "sha1", kwargs)
+        self._upsert("jar", "sha1", kwargs)
+        self.index_jar(kwargs["sha1"])
+
+    def add_rejected_member(self, **kwargs):
+        self._upsert("rejected_member", "jar_sha1, filename", kwargs)
+
+    def clear_rejected_members(self, jar_sha1):
+        c = self.conn.cursor()
+        c.execute("DELETE FROM rejected_member WHERE jar_sha1 = ?", (jar_sha1,))
+
+    def rejected_members(self, jar_sha1):
+        c = self.conn.cursor()
+        c.execute("SELECT filename FROM rejected_member WHERE jar_sha1 = ?", (jar_sha1,))
+        return {row["filename"] for row in c.fetchall()}
+
+    def index_jar(self, jar_sha1):
+        # resources are added before their JAR, so the index is refreshed once the title and
+        # JAR name are known
+        self._index_jars("?", (jar_sha1,))
+
+    def _index_jars(self, jars, params):
+        # jars: SQL list or subquery of the JAR hashes to reindex
+        if self.search_index is None:
+            return
+
+        c = self.conn.cursor()
+        c.execute(
+            "DELETE FROM resource_search WHERE rowid IN "
+            f"(SELECT rowid FROM resource_search_row WHERE jar_sha1 IN ({jars}))",
+            params,
+        )
+        c.execute(f"DELETE FROM resource_search_row WHERE jar_sha1 IN ({jars})", params)
+
+        c.execute(
+            "INSERT INTO resource_search_row (jar_sha1, filename) "
+            "SELECT jar_resource.jar_sha1, jar_resource.filename FROM jar_resource "
+            "JOIN jar ON jar.sha1 = jar_resource.jar_sha1 "
+            "JOIN title ON title.id = jar.title_id "
+            f"WHERE jar_resource.jar_sha1 IN ({jars})",
+            params,
+        )
+        c.execute(
+            "INSERT INTO resource_search (rowid, filename, title, jar, jar_sha1) "
+            "SELECT resource_search_row.rowid, jar_resource.filename, title.name, jar.filename, "
+            "jar_resource.jar_sha1 FROM resource_search_row "
+            "JOIN jar_resource ON jar_resource.jar_sha1 = resource_search_row.jar_sha1 "
+            "AND jar_resource.filename = resource_search_row.filename "
+            "JOIN jar ON jar.sha1 = jar_resource.jar_sha1 "
+            "JOIN title ON title.id = jar.title_id "
+            f"WHERE resource_search_row.jar_sha1 IN ({jars})",
+            params,
+        )
+
+    def rebuild_search_index(self):
+        if self.search_index is None:
+            return
+
+        c = self.conn.cursor()
+        c.execute("DELETE FROM resource_search")
+        c.execute("DELETE FROM resource_search_row")
+        self._index_jars("SELECT sha1 FROM jar", ())
+        self.conn.commit()
 
     def add_resource(self, jar_sha1, filename, **kwargs):
-        upsert(self.conn, "resource", "sha1", kwargs)
-        upsert(
-            self.conn,
+        self._upsert("resource", "sha1", kwargs)
+        self._upsert(
             "jar_resource",
             "jar_sha1, filename",
             dict(jar_sha1=jar_sha1, resource_sha1=kwargs["sha1"], filename=filename),
         )
 
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
     def close(self):
         self.conn.commit()
         self.conn.close()
@@ -110,6 +262,133 @@ class DB:
         c.execute("SELECT id FROM title WHERE name = ?", (name,))
         return c.fetchone()["id"]
 
+    def merge(self, path):
+        # merge a shard DB into this one, applying the same upsert semantics as ingest;
+        # title IDs are local to each DB and must be remapped by name
+        src = sqlite3.connect(str(path))
+        src.row_factory = sqlite3.Row
+
+        title_ids = {row["id"]: self.get_title_id(row["name"]) for row in src.execute("SELECT * FROM title")}
+
+        for row in src.execute("SELECT * FROM jar"):
+            kv = dict(row)
+            kv["title_id"] = title_ids.get(kv["title_id"])
+            self._upsert("jar", "sha1", kv)
+
+        for row in src.execute("SELECT * FROM resource"):
+            self._upsert("resource", "sha1", dict(row))
+
+        for row in src.execute("SELECT * FROM jar_resource"):
+            self._upsert("jar_resource", "jar_sha1, filename", dict(row))
+
+        try:
+            rejected_members = src.execute("SELECT * FROM rejected_member").fetchall()
+        except sqlite3.OperationalError:
+            # shard created before rejected members were recorded
+            rejected_members = []
+
+        for row in rejected_members:
+            self._upsert("rejected_member", "jar_sha1, filename", dict(row))
+
+        # reindex all merged JARs in one pass rather than one statement per JAR
+        c = self.conn.cursor()
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS merged_jar (sha1 TEXT PRIMARY KEY)")
+        c.execute("DELETE FROM merged_jar")
+        c.executemany("INSERT OR IGNORE INTO merged_jar VALUES (?)", src.execute("SELECT sha1 FROM jar"))
+        self._index_jars("SELECT sha1 FROM merged_jar", ())
+
+        src.close()
+        self.conn.commit()
+
+    def verify(self):
+        c = self.conn.cursor()
+
+        problems = [row[0] for row in c.execute("PRAGMA integrity_check") if row[0] != "ok"]
+
+        c.execute("SELECT jar.sha1 FROM jar LEFT JOIN title ON title.id = jar.title_id WHERE title.id IS NULL")
+        problems += [f"jar {row['sha1']}: no such title" for row in c.fetchall()]
+
+        c.execute(
+            "SELECT jar_resource.* FROM jar_resource LEFT JOIN jar ON jar.sha1 = jar_resource.jar_sha1 "
+            "WHERE jar.sha1 IS NULL"
+        )
+        problems += [f"jar_resource {row['jar_sha1']}/{row['filename']}: no such jar" for row in c.fetchall()]
+
+        c.execute(
+            "SELECT jar_resource.* FROM jar_resource LEFT JOIN resource ON resource.sha1 = jar_resource.resource_sha1 "
+            "WHERE resource.sha1 IS NULL"
+        )
+        problems += [f"jar_resource {row['jar_sha1']}/{row['filename']}: no such resource" for row in c.fetchall()]
+
+        return problems
+
+    def search(self, pattern=None, type=None, width=None, height=None, min_size=None, max_size=None, title=None, limit=None):
+        # pattern: a glob such as '*sky*' matched case-insensitively against the resource path,
+        # or plain text looked up in resource paths, titles and JAR names
+        conditions = []
+        params = []
+
+        # matches jar_resource rows against the search index
+        indexed = (
+            "(jar_resource.jar_sha1, jar_resource.filename) IN "
+            "(SELECT jar_sha1, filename FROM resource_search WHERE {})"
+        )
+
+        if pattern is not None and any(ch in pattern for ch in "*?["):
+            conditions.append("lower(jar_resource.filename) GLOB lower(?)")
+            params.append(pattern)
+
+            if self.search_index == "trigram":
+                # LIKE without ESCAPE is index-accelerated but only approximates the glob ('_' and
+                # '%' in the pattern become wildcards, character classes match any character), so
+                # it only narrows down the candidates for the exact GLOB above
+                like = re.sub(r"\[[^\]]*\]", "_", pattern).replace("*", "%").replace("?", "_")
+                conditions.append(indexed.format("filename LIKE ?"))
+                params.append(like)
+        elif pattern is not None and len(pattern) >= 3 and self.search_index == "trigram":
+            conditions.append(indexed.format("resource_search MATCH ?"))
+            params.append('"' + pattern.replace('"', '""') + '"')
+        elif pattern is not None:
+            # too short for trigrams, or no trigram index available
+            like = "%" + re.sub(r"([\\%_])", r"\\\1", pattern) + "%"
+            conditions.append(
+                "(jar_resource.filename LIKE ? ESCAPE '\\' OR title.name LIKE ? ESCAPE '\\' "
+                "OR jar.filename LIKE ? ESCAPE '\\')"
+            )
+            params += [like] * 3
+
+        for condition, value in [
+            ("resource.type = ?", type),
+            ("resource.width = ?", width),
+            ("resource.height = ?", height),
+            ("resource.size >= ?", min_size),
+            ("resource.size <= ?", max_size),
+            ("title.name = ?", title),
+        ]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+
+        query = (
+            "SELECT title.name AS title, jar.filename AS jar_filename, jar_resource.filename, resource.* "
+            "FROM jar_resource JOIN resource ON resource.sha1 = jar_resource.resource_sha1 "
+            "JOIN jar ON jar.sha1 = jar_resource.jar_sha1 "
+            "JOIN title ON title.id = jar.title_id"
+        )
+
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        query += " ORDER BY title.name ASC, jar_resource.filename ASC, jar.filename ASC"
+
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        c = self.conn.cursor()
+        c.execute(query, params)
+        return c.fetchall()
+
     def find_default_model_orientation_for_title(self, title):
         c = games_db.conn.cursor()
         c.execute(
@@ -119,7 +398,7 @@ class DB:
 
         return row if row is not None else (None, None)
 
-    def find_texture_sha1_for_model(self, title, jar_sha1, model_path):
+    def find_texture_path_for_model(self, title, model_path):
         c = games_db.conn.cursor()
         c.execute(
             "SELECT texture_path FROM model_texture WHERE title_name = ? AND model_path = ?",
@@ -127,15 +406,19 @@ class DB:
         )
         row = c.fetchone()
 
-        if row is None:
-            return None
+        return row[0] if row is not None else None
 
-        (texture_path,) = row
+    def find_texture_sha1_for_model(self, title, jar_sha1, model_path):
+        texture_path = self.find_texture_path_for_model(title, model_path)
+
+        if texture_path is None:
+            return None
 
         c = self.conn.cursor()
         c.execute("SELECT resource_sha1 FROM jar_resource WHERE jar_sha1 = ? AND filename = ?", (jar_sha1, texture_path))
-        ((sha1,),) = c.fetchall()
-        return sha1
+        row = c.fetchone()
+
+        return row[0] if row is not None else None
 
     def jars(self, title_name):
         c = self.conn.cursor()
@@ -145,6 +428,15 @@ class DB:
         )
         return c.fetchall()
 
+    def has_jar(self, title_name, filename, size):
+        c = self.conn.cursor()
+        c.execute(
+            "SELECT 1 FROM jar JOIN title ON jar.title_id = title.id "
+            "WHERE title.name = ? AND jar.filename = ? AND jar.size = ?",
+            (title_name, filename, size),
+        )
+        return c.fetchone() is not None
+
     def titles(self):
         c = self.conn.cursor()
         c.execute("SELECT name FROM title ORDER BY name ASC")
@@ -164,7 +456,8 @@ class DB:
 
 
 class PreviewsDB:
-    def __init__(self, path):
+    def __init__(self, path, stats=None):
+        self.stats = stats
         self.conn = sqlite3.connect(str(path))
         self.conn.row_factory = sqlite3.Row
 
@@ -200,17 +493,161 @@ class PreviewsDB:
         except sqlite3.OperationalError:
             pass
 
+        # perceptual hash of each previewed image; near-duplicates share the preview files of
+        # their cluster's canonical image
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS image_phash (
+                    sha1 TEXT PRIMARY KEY,
+                    phash TEXT NOT NULL,
+                    width INT,
+                    height INT,
+                    canonical_sha1 TEXT NOT NULL
+                    )
+            """
+        )
+
         self.conn.commit()
 
     def add_mbac_preview(self, **kwargs):
         upsert(self.conn, "mbac_preview", "sha1, thumb", kwargs)
         self.conn.commit()
 
+        if self.stats is not None:
+            self.stats.count("db_rows_written")
+
     def close(self):
         self.conn.commit()
         self.conn.close()
 
+    def add_image_phash(self, **kwargs):
+        upsert(self.conn, "image_phash", "sha1", kwargs)
+        self.conn.commit()
+
+        if self.stats is not None:
+            self.stats.count("db_rows_written")
+
+    def get_image_phash(self, sha1):
+        c = self.conn.cursor()
+        c.execute("SELECT * FROM image_phash WHERE sha1 = ?", (sha1,))
+        return c.fetchone()
+
+    def canonical_image_phashes(self):
+        c = self.conn.cursor()
+        c.execute("SELECT * FROM image_phash WHERE canonical_sha1 = sha1")
+        return c.fetchall()
+
+    def discard_image_phashes(self, length):
+        c = self.conn.cursor()
+        c.execute("DELETE FROM image_phash WHERE length(phash) != ?", (length,))
+        self.conn.commit()
+
+    def canonical_image_sha1(self, sha1):
+        c = self.conn.cursor()
+        c.execute("SELECT canonical_sha1 FROM image_phash WHERE sha1 = ?", (sha1,))
+        row = c.fetchone()
+        return row["canonical_sha1"] if row is not None else sha1
+
+    def merge(self, path):
+        src = sqlite3.connect(str(path))
+        src.row_factory = sqlite3.Row
+
+        for row in src.execute("SELECT * FROM mbac_preview"):
+            upsert(self.conn, "mbac_preview", "sha1, thumb", dict(row))
+
+            if self.stats is not None:
+                self.stats.count("db_rows_written")
+
+        try:
+            image_phashes = src.execute("SELECT * FROM image_phash").fetchall()
+        except sqlite3.OperationalError:
+            # shard created before perceptual hashing was introduced
+            image_phashes = []
+
+        for row in image_phashes:
+            upsert(self.conn, "image_phash", "sha1", dict(row))
+
+            if self.stats is not None:
+                self.stats.count("db_rows_written")
+
+        src.close()
+        self.conn.commit()
+
+    def verify(self, workdir):
+        c = self.conn.cursor()
+
+        problems = [row[0] for row in c.execute("PRAGMA integrity_check") if row[0] != "ok"]
+
+        for row in c.execute("SELECT sha1, thumb, filename FROM mbac_preview"):
+            if row["filename"] is not None and not (workdir / row["filename"]).is_file():
+                problems.append(f"mbac_preview {row['sha1']} thumb={row['thumb']}: missing {row['filename']}")
+
+        for row in c.execute("SELECT DISTINCT canonical_sha1 FROM image_phash"):
+            for rel_dir in ["full", "thumbs"]:
+                if not (workdir / rel_dir / f"{row['canonical_sha1']}.png").is_file():
+                    problems.append(f"image_phash {row['canonical_sha1']}: missing {rel_dir}/{row['canonical_sha1']}.png")
+
+        return problems
+
     def get_mbac_preview(self, sha1, thumb):
         c = self.conn.cursor()
         c.execute("SELECT * FROM mbac_preview WHERE sha1 = ? AND thumb = ?", (sha1, thumb))
         return c.fetchone()
+
+
+class QueueDB:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(str(path))
+        self.conn.row_factory = sqlite3.Row
+
+        c = self.conn.cursor()
+
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jar_queue (
+                    path TEXT PRIMARY KEY,
+                    queued_at REAL NOT NULL,
+                    failures INT NOT NULL DEFAULT 0
+                    )
+            """
+        )
+
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def enqueue(self, path, queued_at):
+        # re-queueing a path resets its debounce timer and failure count
+        upsert(self.conn, "jar_queue", "path", dict(path=str(path), queued_at=queued_at, failures=0))
+        self.conn.commit()
+
+    def ready(self, before, max_failures):
+        c = self.conn.cursor()
+        c.execute(
+            "SELECT * FROM jar_queue WHERE queued_at <= ? AND failures < ? ORDER BY path ASC",
+            (before, max_failures),
+        )
+        return c.fetchall()
+
+    def next_deadline(self, max_failures):
+        c = self.conn.cursor()
+        c.execute("SELECT MIN(queued_at) FROM jar_queue WHERE failures < ?", (max_failures,))
+        (queued_at,) = c.fetchone()
+        return queued_at
+
+    def done(self, row):
+        # only drop the entry if it wasn't re-queued while being processed
+        c = self.conn.cursor()
+        c.execute("DELETE FROM jar_queue WHERE path = ? AND queued_at = ?", (row["path"], row["queued_at"]))
+        self.conn.commit()
+
+    def failed(self, row, retry_at):
+        # moving queued_at forward delays the retry
+        c = self.conn.cursor()
+        c.execute(
+            "UPDATE jar_queue SET failures = failures + 1, queued_at = ? WHERE path = ? AND queued_at = ?",
+            (retry_at, row["path"], row["queued_at"]),
+        )
+        self.conn.commit()
@@ -0,0 +1,210 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+
+import brotli
+
+from make_html import STYLESHEET_INTEGRITY, STYLESHEET_URL
+
+# upstream purecss build; exported in place of the unpkg link once it is committed
+VENDORED_STYLESHEET = Path(__file__).parent / "static" / "pure-min.css"
+
+ASSET_DIRS = ["full", "thumbs"]
+
+# text formats worth serving precompressed; images are already compressed
+PRECOMPRESSED_SUFFIXES = {".html", ".json", ".css"}
+
+EXPORT_MANIFEST = "export-manifest.json"
+ASSET_MANIFEST = "asset-manifest.json"
+DEPLOY_MANIFEST = "deploy-manifest.json"
+
+URL_ATTRIBUTE = re.compile(r"""(src|href)=(["'])([^"']+)\2""")
+
+
+def subresource_integrity(data):
+    return "sha384-" + base64.b64encode(hashlib.sha384(data).digest()).decode()
+
+
+def vendored_stylesheet():
+    # never downloaded; without a committed copy the pages keep linking to unpkg
+    try:
+        data = VENDORED_STYLESHEET.read_bytes()
+    except FileNotFoundError:
+        return None
+
+    if subresource_integrity(data) != STYLESHEET_INTEGRITY:
+        raise ValueError(f"{VENDORED_STYLESHEET}: not the pinned {STYLESHEET_URL}")
+
+    return data
+
+
+def fingerprint(rel, digest):
+    # full/abc.png -> full/abc.0123456789ab.png
+    p = Path(rel)
+    return str(p.with_name(f"{p.stem}.{digest[:12]}{p.suffix}"))
+
+
+class Exporter:
+    def __init__(self, outputdir, exportdir, stats):
+        self.outputdir = outputdir
+        self.exportdir = exportdir
+        self.stats = stats
+
+        try:
+            previous = json.loads((exportdir / EXPORT_MANIFEST).read_text())
+        except FileNotFoundError:
+            previous = dict(files=dict(), sources=dict())
+
+        self.previous_files = previous["files"]
+        self.previous_sources = previous["sources"]
+
+        # relative path in export -> content digest
+        self.files = dict()
+        # relative path in outputdir -> [size, mtime_ns, digest], so unchanged images aren't rehashed
+        self.sources = dict()
+
+        self.added = []
+        self.changed = []
+
+    def source_digest(self, path, rel):
+        st = path.stat()
+
+        try:
+            size, mtime_ns, digest = self.previous_sources[rel]
+
+            if size == st.st_size and mtime_ns == st.st_mtime_ns:
+                self.sources[rel] = [size, mtime_ns, digest]
+                self.stats.count("export_hash_cache_hits")
+                return digest
+        except KeyError:
+            pass
+
+        with self.stats.stage("export_hash"):
+            h = hashlib.sha256()
+
+            with open(path, "rb", buffering=0) as f:
+                for b in iter(lambda: f.read(128 * 1024), b""):
+                    h.update(b)
+
+        self.sources[rel] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+        return h.hexdigest()
+
+    def is_current(self, rel, digest):
+        return self.previous_files.get(rel) == digest and (self.exportdir / rel).is_file()
+
+    def record(self, rel, digest):
+        if rel not in self.previous_files:
+            self.added.append(rel)
+        elif self.previous_files[rel] != digest:
+            self.changed.append(rel)
+
+        self.files[rel] = digest
+
+    def write(self, rel, data, digest=None):
+        if digest is None:
+            digest = hashlib.sha256(data).hexdigest()
+
+        variants = [(rel, lambda: data)]
+
+        if Path(rel).suffix in PRECOMPRESSED_SUFFIXES:
+            # mtime=0 keeps the output stable, so unchanged files don't show up as changed
+            variants.append((rel + ".gz", lambda: gzip.compress(data, compresslevel=9, mtime=0)))
+            variants.append((rel + ".br", lambda: brotli.compress(data)))
+
+        for variant_rel, make_data in variants:
+            if not self.is_current(variant_rel, digest):
+                path = self.exportdir / variant_rel
+                path.parent.mkdir(parents=True, exist_ok=True)
+
+                with self.stats.stage("export_write"):
+                    tmp_path = path.with_name(path.name + ".tmp")
+                    tmp_path.write_bytes(make_data())
+                    os.replace(tmp_path, path)
+
+                self.stats.count("export_files_written")
+
+            self.record(variant_rel, digest)
+
+    def export_assets(self):
+        assets = dict()
+
+        for asset_dir in ASSET_DIRS:
+            for path in sorted((self.outputdir / asset_dir).glob("*.png")):
+                rel = f"{asset_dir}/{path.name}"
+                digest = self.source_digest(path, rel)
+                exported_rel = fingerprint(rel, digest)
+
+                if not self.is_current(exported_rel, digest):
+                    self.write(exported_rel, path.read_bytes(), digest)
+                else:
+                    self.record(exported_rel, digest)
+
+                assets[rel] = exported_rel
+
+        return assets
+
+    def export_pages(self, assets, stylesheet_rel):
+        def rewrite(match):
+            attribute, quote, url = match.groups()
+
+            if url == STYLESHEET_URL and stylesheet_rel is not None:
+                url = stylesheet_rel
+            else:
+                url = assets.get(url, url)
+
+            return f"{attribute}={quote}{url}{quote}"
+
+        for path in sorted(self.outputdir.glob("*.html")):
+            with self.stats.stage("export_pages"):
+                html = URL_ATTRIBUTE.sub(rewrite, path.read_text())
+
+            self.write(path.name, html.encode())
+
+    def remove_stale(self):
+        removed = sorted(set(self.previous_files) - set(self.files))
+
+        for rel in removed:
+            try:
+                (self.exportdir / rel).unlink()
+            except FileNotFoundError:
+                pass
+
+        return removed
+
+    def run(self):
+        self.exportdir.mkdir(parents=True, exist_ok=True)
+
+        assets = self.export_assets()
+
+        stylesheet = vendored_stylesheet()
+
+        if stylesheet is not None:
+            stylesheet_rel = fingerprint("pure-min.css", hashlib.sha256(stylesheet).hexdigest())
+            self.write(stylesheet_rel, stylesheet)
+            assets["pure-min.css"] = stylesheet_rel
+        else:
+            stylesheet_rel = None
+
+        self.export_pages(assets, stylesheet_rel)
+
+        # fingerprinted paths can be served with far-future cache headers; everything else
+        # (HTML, manifests) must be revalidated
+        self.write(ASSET_MANIFEST, json.dumps(assets, indent=1, sort_keys=True).encode())
+
+        removed = self.remove_stale()
+
+        deploy_manifest = dict(added=sorted(self.added), changed=sorted(self.changed), removed=removed)
+        (self.exportdir / DEPLOY_MANIFEST).write_text(json.dumps(deploy_manifest, indent=1))
+
+        export_manifest = dict(files=self.files, sources=self.sources)
+        (self.exportdir / EXPORT_MANIFEST).write_text(json.dumps(export_manifest, indent=1, sort_keys=True))
+
+        self.stats.count("export_added", len(self.added))
+        self.stats.count("export_changed", len(self.changed))
+        self.stats.count("export_removed", len(removed))
+
+        return deploy_manifest
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+import argparse
+from pathlib import Path
+import shutil
+import signal
+import sys
+
+from archive import add_limit_arguments, limits_from_args, parse_shard
+from db import DB, PreviewsDB
+from export import Exporter
+import instrumentation
+from pipeline import Pipeline
+from update_previews import PHASH_DISTANCE
+from watch import Watcher
+
+
+def run(args):
+    stats = instrumentation.from_args(args)
+    pipeline = Pipeline(
+        args.db,
+        args.workdir,
+        stats,
+        resource=args.resource,
+        shard=args.shard,
+        phash_distance=args.phash_distance,
+        limits=limits_from_args(args),
+    )
+
+    pipeline.run(args.jars)
+
+    pipeline.close()
+
+
+def watch(args):
+    stats = instrumentation.from_args(args)
+    pipeline = Pipeline(args.db, args.workdir, stats, limits=limits_from_args(args))
+    watcher = Watcher(pipeline, args.root, args.workdir / "watch-queue.sqlite", stats, debounce=args.debounce)
+
+    # exit cleanly under a service manager too, so that the DBs are committed and the summary printed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        watcher.run(scan=args.scan)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        pipeline.close()
+
+
+def report_problems(problems):
+    for problem in problems:
+        print("integrity:", problem, file=sys.stderr)
+
+    if problems:
+        sys.exit(1)
+
+
+def merge(args):
+    stats = instrumentation.from_args(args)
+    db = DB(args.db, stats=stats)
+
+    for shard_db in args.shard_dbs:
+        with stats.stage("merge"):
+            stats.event("merge", "MERGE", shard_db, path=str(shard_db))
+            db.merge(shard_db)
+
+    with stats.stage("verify"):
+        problems = db.verify()
+
+    db.close()
+    report_problems(problems)
+
+
+def merge_previews(args):
+    stats = instrumentation.from_args(args)
+
+    for rel_dir in ["full", "thumbs"]:
+        (args.workdir / rel_dir).mkdir(parents=True, exist_ok=True)
+
+    previews_db = PreviewsDB(args.workdir / "previews.sqlite", stats=stats)
+
+    for shard_workdir in args.shard_workdirs:
+        stats.event("merge", "MERGE", shard_workdir, path=str(shard_workdir))
+
+        with stats.stage("merge"):
+            previews_db.merge(shard_workdir / "previews.sqlite")
+
+        with stats.stage("copy_previews"):
+            for rel_dir in ["full", "thumbs"]:
+                for src in (shard_workdir / rel_dir).glob("*.png"):
+                    dest = args.workdir / rel_dir / src.name
+
+                    if not dest.is_file() or dest.stat().st_mtime < src.stat().st_mtime:
+                        shutil.copy2(src, dest)
+                        stats.count("previews_copied")
+
+    with stats.stage("verify"):
+        problems = previews_db.verify(args.workdir)
+
+    previews_db.close()
+    report_problems(problems)
+
+
+def parse_dimensions(value):
+    try:
+        width, height = (int(part) for part in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, got {value!r}")
+
+    return width, height
+
+
+def search(args):
+    db = DB(args.db)
+
+    if args.rebuild_index:
+        db.rebuild_search_index()
+
+    type = None
+    if args.type is not None:
+        type = "." + args.type.lstrip(".").upper()
+
+    width, height = args.dimensions if args.dimensions is not None else (None, None)
+
+    for row in db.search(
+        pattern=args.pattern,
+        type=type,
+        width=width,
+        height=height,
+        min_size=args.min_bytes,
+        max_size=args.max_bytes,
+        title=args.title,
+        limit=args.limit,
+    ):
+        dimensions = f"{row['width']}x{row['height']}" if row["width"] and row["height"] else "-"
+        print(
+            row["title"], row["jar_filename"], row["filename"], row["type"], dimensions, row["size"], row["sha1"], sep="\t"
+        )
+
+    db.close()
+
+
+def export(args):
+    stats = instrumentation.from_args(args)
+    deploy_manifest = Exporter(args.workdir, args.exportdir, stats).run()
+
+    stats.event(
+        "export",
+        f"EXPORT added={len(deploy_manifest['added'])} changed={len(deploy_manifest['changed'])} "
+        f"removed={len(deploy_manifest['removed'])}",
+        **deploy_manifest,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="ingest JARs, update previews and regenerate pages")
+    run_parser.add_argument("db")
+    run_parser.add_argument("workdir", type=Path)
+    run_parser.add_argument("--resource")
+    run_parser.add_argument(
+        "--shard", type=parse_shard, metavar="K/N", help="only process JARs assigned to shard K of N (by SHA-1)"
+    )
+    run_parser.add_argument(
+        "--phash-distance",
+        type=int,
+        default=PHASH_DISTANCE,
+        help="maximum perceptual hash distance between near-duplicate images sharing a preview",
+    )
+    run_parser.add_argument("--no-dedup", dest="phash_distance", action="store_const", const=None)
+    run_parser.add_argument("jars", nargs="+", type=Path)
+    add_limit_arguments(run_parser)
+    instrumentation.add_arguments(run_parser)
+    run_parser.set_defaults(func=run)
+
+    watch_parser = subparsers.add_parser("watch", help="ingest new JARs under ROOT as they appear")
+    watch_parser.add_argument("db")
+    watch_parser.add_argument("workdir", type=Path)
+    watch_parser.add_argument("root", type=Path, help="archive root laid out as <title>/<file>.jar")
+    watch_parser.add_argument("--debounce", type=float, default=5.0, metavar="SECONDS")
+    watch_parser.add_argument("--scan", action="store_true", help="also queue JARs missing from the DB on startup")
+    add_limit_arguments(watch_parser)
+    instrumentation.add_arguments(watch_parser)
+    watch_parser.set_defaults(func=watch)
+
+    search_parser = subparsers.add_parser("search", help="find resources by name and attributes")
+    search_parser.add_argument("db")
+    search_parser.add_argument(
+        "pattern", nargs="?", help="glob matched against resource paths (e.g. '*sky*'), or text to look up"
+    )
+    search_parser.add_argument("--type", help="resource type, e.g. BMP, PNG, MBAC")
+    search_parser.add_argument("--size", dest="dimensions", type=parse_dimensions, metavar="WxH")
+    search_parser.add_argument("--min-bytes", type=int)
+    search_parser.add_argument("--max-bytes", type=int)
+    search_parser.add_argument("--title")
+    search_parser.add_argument("--limit", type=int)
+    search_parser.add_argument("--rebuild-index", action="store_true")
+    search_parser.set_defaults(func=search)
+
+    export_parser = subparsers.add_parser(
+        "export", help="write a precompressed, fingerprinted copy of WORKDIR for static hosting"
+    )
+    export_parser.add_argument("workdir", type=Path)
+    export_parser.add_argument("exportdir", type=Path)
+    instrumentation.add_arguments(export_parser)
+    export_parser.set_defaults(func=export)
+
+    merge_parser = subparsers.add_parser("merge", help="merge shard DBs into DB")
+    merge_parser.add_argument("db")
+    merge_parser.add_argument("shard_dbs", nargs="+", type=Path)
+    instrumentation.add_arguments(merge_parser)
+    merge_parser.set_defaults(func=merge)
+
+    merge_previews_parser = subparsers.add_parser(
+        "merge-previews", help="merge shard preview DBs and images into WORKDIR"
+    )
+    merge_previews_parser.add_argument("workdir", type=Path)
+    merge_previews_parser.add_argument("shard_workdirs", nargs="+", type=Path)
+    instrumentation.add_arguments(merge_previews_parser)
+    merge_previews_parser.set_defaults(func=merge_previews)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import atexit
+import cProfile
+import json
+from pathlib import Path
+import pstats
+import sys
+import time
+
+
+class Instrumentation:
+    def __init__(self, progress=None, profile_dir=None):
+        # progress: file object receiving one JSON object per line, or None for plain text output
+        self.progress = progress
+        self.profile_dir = profile_dir
+
+        self.counters = Counter()
+        self.timings = defaultdict(float)
+        self.calls = Counter()
+        self.profilers = dict()
+        self.active_profiler = None
+
+        self.start_time = time.perf_counter()
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def event(self, event, *text, file=sys.stdout, **fields):
+        if self.progress is not None:
+            record = dict(t=round(time.time(), 3), event=event, **fields)
+            print(json.dumps(record, default=str), file=self.progress, flush=True)
+
+            # don't interleave plain text with JSON lines on the same stream
+            if self.progress is file:
+                return
+
+        print(*text, file=file)
+
+    @contextmanager
+    def stage(self, name):
+        # cProfile can only have one active profiler at a time, so an enclosing stage's profiler is
+        # suspended while a nested stage runs; each stage's dump then covers only its own samples
+        profiler = None
+        outer_profiler = self.active_profiler
+
+        if self.profile_dir is not None:
+            try:
+                profiler = self.profilers[name]
+            except KeyError:
+                profiler = self.profilers[name] = cProfile.Profile()
+
+            if outer_profiler is not None:
+                outer_profiler.disable()
+
+            self.active_profiler = profiler
+            profiler.enable()
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+            if profiler is not None:
+                profiler.disable()
+                self.active_profiler = outer_profiler
+
+                if outer_profiler is not None:
+                    outer_profiler.enable()
+
+    def dump_profiles(self):
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+
+        for name, profiler in self.profilers.items():
+            stats = pstats.Stats(profiler)
+            stats.dump_stats(self.profile_dir / f"{name}.pstats")
+
+    def summary(self, file=sys.stderr):
+        elapsed = time.perf_counter() - self.start_time
+
+        if self.progress is not None:
+            record = dict(
+                t=round(time.time(), 3),
+                event="summary",
+                elapsed=round(elapsed, 3),
+                stages={name: dict(seconds=round(t, 3), calls=self.calls[name]) for name, t in self.timings.items()},
+                counters=dict(self.counters),
+            )
+            print(json.dumps(record), file=self.progress, flush=True)
+
+        if self.profile_dir is not None:
+            self.dump_profiles()
+
+        if self.progress is file:
+            return
+
+        print(f"--- summary ({elapsed:.1f} s) ---", file=file)
+
+        for name, t in sorted(self.timings.items(), key=lambda item: -item[1]):
+            print(f"{name:24} {t:10.2f} s {self.calls[name]:8} calls", file=file)
+
+        for name, value in sorted(self.counters.items()):
+            print(f"{name:24} {value:12}", file=file)
+
+
+def add_arguments(parser):
+    parser.add_argument("--profile", type=Path, metavar="DIR", help="write cProfile stats per stage to DIR")
+    parser.add_argument(
+        "--progress-json", metavar="FILE", help="write JSON-lines progress events to FILE ('-' for stdout)"
+    )
+
+
+def from_args(args):
+    if args.progress_json == "-":
+        progress = sys.stdout
+    elif args.progress_json is not None:
+        progress = open(args.progress_json, "at", buffering=1)
+    else:
+        progress = None
+
+    instrumentation = Instrumentation(progress=progress, profile_dir=args.profile)
+    atexit.register(instrumentation.summary)
+    return instrumentation
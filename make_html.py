@@ -9,43 +9,51 @@ import zipfile
 
 from PIL import Image
 
-from db import DB
+from db import DB, PreviewsDB
+import instrumentation
 
-parser = argparse.ArgumentParser()
-parser.add_argument("db")
-parser.add_argument("outputdir", type=Path)
+STYLESHEET_URL = "https://unpkg.com/purecss@1.0.1/build/pure-min.css"
+STYLESHEET_INTEGRITY = "sha384-oAOxQR6DkCoMliIh8yFnu25d7Eq/PHS21PClpwjOTeU2jRSq11vu66rf90/cZr47"
 
-args = parser.parse_args()
+STYLESHEET = (
+    f'<link rel="stylesheet" href="{STYLESHEET_URL}" '
+    f'integrity="{STYLESHEET_INTEGRITY}" '
+    'crossorigin="anonymous">'
+)
 
-db = DB(args.db)
 
-args.outputdir.mkdir(exist_ok=True)
+# https://stackoverflow.com/a/1094933
+def sizeof_fmt(num, suffix="B"):
+    for unit in ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"]:
+        if abs(num) < 1024.0:
+            return "%3.1f%s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f%s%s" % (num, "Yi", suffix)
 
-full_dir = args.outputdir / "full"
-thumbs_dir = args.outputdir / "thumbs"
 
 # TODO: should obviously use Jinja or something
-with open(args.outputdir / "index.html", "wt") as f:
-    f.write(
-        '<link rel="stylesheet" href="https://unpkg.com/purecss@1.0.1/build/pure-min.css" '
-        'integrity="sha384-oAOxQR6DkCoMliIh8yFnu25d7Eq/PHS21PClpwjOTeU2jRSq11vu66rf90/cZr47" '
-        'crossorigin="anonymous">\n'
-    )
+def write_index(db, outputdir, stats):
+    with stats.stage("index_page"), open(outputdir / "index.html", "wt") as f:
+        f.write(STYLESHEET + "\n")
+
+        for title in db.titles():
+            f.write(f"<h1><a href='{title + '.html'}'>{title}</a></h1>\n")
+
+    stats.count("pages_written")
+
 
-    # https://stackoverflow.com/a/1094933
-    def sizeof_fmt(num, suffix="B"):
-        for unit in ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"]:
-            if abs(num) < 1024.0:
-                return "%3.1f%s%s" % (num, unit, suffix)
-            num /= 1024.0
-        return "%.1f%s%s" % (num, "Yi", suffix)
+def write_title_page(db, outputdir, title, stats, previews_db=None, dedup=True):
+    full_dir = outputdir / "full"
+    thumbs_dir = outputdir / "thumbs"
 
-    for title in db.titles():
-        f.write(f"<h1><a href='{title + '.html'}'>{title}</a></h1>\n")
+    def preview_sha1(res):
+        # near-duplicate images share the preview of their cluster's canonical image
+        if previews_db is None or not dedup or res["type"] == ".MBAC":
+            return res["sha1"]
 
-        f1 = f
-        f = open(args.outputdir / (title + ".html"), "wt")
+        return previews_db.canonical_image_sha1(res["sha1"])
 
+    with stats.stage("title_page"), open(outputdir / (title + ".html"), "wt") as f:
         # sort resources by path
         resources_by_path = dict()
 
@@ -57,11 +65,7 @@ with open(args.outputdir / "index.html", "wt") as f:
             except KeyError:
                 resources_by_path[p.parent] = [res]
 
-        f.write(
-            '<link rel="stylesheet" href="https://unpkg.com/purecss@1.0.1/build/pure-min.css" '
-            'integrity="sha384-oAOxQR6DkCoMliIh8yFnu25d7Eq/PHS21PClpwjOTeU2jRSq11vu66rf90/cZr47" '
-            'crossorigin="anonymous">'
-        )
+        f.write(STYLESHEET)
 
         f.write(f"<h1>{title}</h1>")
 
@@ -73,10 +77,15 @@ with open(args.outputdir / "index.html", "wt") as f:
         )
 
         for jar in db.jars(title_name=title):
+            # the icon may be missing if it exceeded the ingest limits
+            icon = ""
+            if jar["icon"] is not None:
+                icon = f'<img src="data:image/png;base64,{base64.b64encode(jar["icon"]).decode()}">'
+
             f.write(
                 f"""
                 <tr>
-                  <td><img src="data:image/png;base64,{base64.b64encode(jar["icon"]).decode()}"></td>
+                  <td>{icon}</td>
                   <td><p>{jar["filename"]}</p><p style="font-size: 10px; opacity: 0.5">{jar["sha1"]}</p></td>
                   <td>{sizeof_fmt(jar['size'])}</td>
                   <td>{jar['detected_mascot']}</td>
@@ -89,24 +98,52 @@ with open(args.outputdir / "index.html", "wt") as f:
 
         f.write("</table>")
 
-        def display_cell(f, res):
-            f.write('<div class="pure-u-1-6" style="text-align: center">')
+        def display_cell(f, res, variants=0):
+            sha1 = preview_sha1(res)
 
-            if not (full_dir / f'{res["sha1"]}.png').is_file():
-                print("warning: no such file", str(full_dir / f'{res["sha1"]}.png'))
-            # thumb = (thumbs_dir / f'{res["sha1"]}.png').is_file()
+            f.write('<div class="pure-u-1-6" style="text-align: center">')
 
-            f.write(f'<a href="full/{res["sha1"]}.png">')
-            f.write(f'<img src="thumbs/{res["sha1"]}.png">')
+            if not (full_dir / f"{sha1}.png").is_file():
+                stats.count("missing_previews")
+                stats.event(
+                    "missing_preview",
+                    "warning: no such file",
+                    str(full_dir / f"{sha1}.png"),
+                    path=str(full_dir / f"{sha1}.png"),
+                )
+            # thumb = (thumbs_dir / f"{sha1}.png").is_file()
+
+            f.write(f'<a href="full/{sha1}.png">')
+            f.write(f'<img src="thumbs/{sha1}.png">')
             f.write("</a>")
 
             p = Path(res["filename"])
             f.write(f'<p style="font-size: 12px">{p.name}</p>')
             if res["width"] and res["height"]:
                 f.write(f'<p style="font-size: 12px">{res["width"]} x {res["height"]}</p>')
+            if variants:
+                f.write(f'<p style="font-size: 12px">+{variants} near-duplicate{"s" if variants > 1 else ""}</p>')
             f.write(f'<p style="font-size: 10px; opacity: 0.5">{res["sha1"]}</p>')
             f.write("</div>\n")
 
+        def display_images(f, type):
+            # one cell per near-duplicate cluster, listing how many other variants it stands for
+            clusters = dict()
+
+            for res in db.resources(title_name=title):
+                if res["type"] == type:
+                    try:
+                        clusters[preview_sha1(res)].append(res)
+                    except KeyError:
+                        clusters[preview_sha1(res)] = [res]
+
+            for resources in clusters.values():
+                variants = len({res["sha1"] for res in resources}) - 1
+                display_cell(f, resources[0], variants=variants)
+
+                if variants:
+                    stats.count("near_duplicates_collapsed", variants)
+
         f.write("<h2>Models</h2>")
 
         for path, resources in resources_by_path.items():
@@ -126,9 +163,7 @@ with open(args.outputdir / "index.html", "wt") as f:
 
         f.write('<div class="pure-g">\n')
 
-        for res in db.resources(title_name=title):
-            if res["type"] == ".BMP":
-                display_cell(f, res)
+        display_images(f, ".BMP")
 
         f.write("</div>")
 
@@ -136,13 +171,46 @@ with open(args.outputdir / "index.html", "wt") as f:
 
         f.write('<div class="pure-g">\n')
 
-        for res in db.resources(title_name=title):
-            if res["type"] == ".PNG":
-                display_cell(f, res)
+        display_images(f, ".PNG")
 
         f.write("</div>")
 
-        f.close()
-        f = f1
+    stats.count("pages_written")
+
+
+def make_html(db, outputdir, stats, titles=None, previews_db=None, dedup=True):
+    outputdir.mkdir(exist_ok=True)
+
+    write_index(db, outputdir, stats)
+
+    for title in titles if titles is not None else db.titles():
+        write_title_page(db, outputdir, title, stats, previews_db=previews_db, dedup=dedup)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db")
+    parser.add_argument("outputdir", type=Path)
+    parser.add_argument(
+        "--no-dedup", dest="dedup", action="store_false", help="show near-duplicate images separately"
+    )
+    instrumentation.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    stats = instrumentation.from_args(args)
+    db = DB(args.db, stats=stats)
+
+    previews_path = args.outputdir / "previews.sqlite"
+    previews_db = PreviewsDB(previews_path) if previews_path.is_file() else None
+
+    make_html(db, args.outputdir, stats, previews_db=previews_db, dedup=args.dedup)
+
+    if previews_db is not None:
+        previews_db.close()
+
+    db.close()
+
 
-db.close()
+if __name__ == "__main__":
+    main()
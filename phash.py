@@ -0,0 +1,123 @@
+import numpy as np
+
+from PIL import Image
+
+# Perceptual hash of an RGBA image: for each channel, the signs of the low-frequency DCT
+# coefficients relative to their median (structure) plus a thermometer code of the channel mean
+# (brightness), so that images differing only in hue or tint are far apart. Candidates found by
+# hash should still be confirmed with pixel_difference().
+
+SIZE = 32
+LOW_FREQUENCIES = 8
+CHANNELS = 4
+MEAN_LEVELS = 9
+BITS = CHANNELS * (LOW_FREQUENCIES * LOW_FREQUENCIES + MEAN_LEVELS - 1)
+
+SIGNATURE_SIZE = 16
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, np.newaxis]
+    i = np.arange(n)[np.newaxis, :]
+
+    m = np.sqrt(2 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    m[0] /= np.sqrt(2)
+    return m
+
+
+DCT = _dct_matrix(SIZE)
+
+
+def _pixels(image, size):
+    # (size, size, CHANNELS) -> (CHANNELS, size, size)
+    pixels = np.asarray(image.convert("RGBA").resize((size, size), Image.BILINEAR), dtype=np.float64)
+    return pixels.transpose(2, 0, 1)
+
+
+def phash(image):
+    channels = _pixels(image, SIZE)
+
+    # 2D DCT of all channels at once
+    dct = DCT @ channels @ DCT.T
+
+    low = dct[:, :LOW_FREQUENCIES, :LOW_FREQUENCIES].reshape(CHANNELS, -1)
+
+    # rounding keeps flat channels (e.g. an opaque alpha) at all-zero bits instead of float noise
+    low = np.round(low, 6)
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    structure_bits = low > median
+
+    # the Hamming distance between thermometer codes is the difference in levels
+    levels = np.floor(channels.mean(axis=(1, 2)) * MEAN_LEVELS / 256)
+    mean_bits = np.arange(1, MEAN_LEVELS)[np.newaxis, :] <= levels[:, np.newaxis]
+
+    bits = np.concatenate([structure_bits, mean_bits], axis=1)
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def signature(image):
+    return _pixels(image, SIGNATURE_SIZE)
+
+
+def pixel_difference(a, b):
+    # mean absolute difference of two signatures, 0 (identical) .. 1
+    return float(np.abs(a - b).mean()) / 255
+
+
+def to_hex(h):
+    return f"{h:0{BITS // 4}x}"
+
+
+def from_hex(s):
+    return int(s, 16)
+
+
+def distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    # Burkhard-Keller tree over hashes in Hamming space, for radius queries without a full scan
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, h, value):
+        if self.root is None:
+            self.root = (h, value, dict())
+            return
+
+        node = self.root
+
+        while True:
+            d = distance(h, node[0])
+            children = node[2]
+
+            try:
+                node = children[d]
+            except KeyError:
+                children[d] = (h, value, dict())
+                return
+
+    def find(self, h, max_distance):
+        # returns [(distance, value)] sorted by distance
+        found = []
+
+        if self.root is None:
+            return found
+
+        stack = [self.root]
+
+        while stack:
+            node_hash, value, children = stack.pop()
+            d = distance(h, node_hash)
+
+            if d <= max_distance:
+                found.append((d, value))
+
+            for child_distance, child in children.items():
+                if d - max_distance <= child_distance <= d + max_distance:
+                    stack.append(child)
+
+        found.sort(key=lambda item: item[0])
+        return found
@@ -0,0 +1,81 @@
+from archive import Jar, shard_of
+from build_db import ingest_jar
+from db import DB
+from make_html import write_index, write_title_page
+from update_previews import PHASH_DISTANCE, Previewer
+
+
+class Pipeline:
+    # Streams JARs through ingest -> previews -> page regeneration in a single process, keeping the
+    # DB connections open for the whole run and each archive open across all of its stages
+
+    def __init__(
+        self, db_path, workdir, stats, resource=None, shard=None, phash_distance=PHASH_DISTANCE, limits=None
+    ):
+        self.workdir = workdir
+        self.stats = stats
+        self.shard = shard
+        self.limits = limits
+        self.dedup = phash_distance is not None
+
+        self.db = DB(db_path, stats=stats)
+        self.previewer = Previewer(self.db, workdir, stats, resource=resource, phash_distance=phash_distance)
+
+    def close(self):
+        self.previewer.close()
+        self.db.close()
+
+    def process_jar(self, path):
+        with Jar(path, stats=self.stats, limits=self.limits) as jar:
+            if self.shard is not None:
+                index, count = self.shard
+
+                if shard_of(jar.sha1, count) != index:
+                    self.stats.count("jars_in_other_shards")
+                    return None
+
+            try:
+                if not ingest_jar(self.db, jar, self.stats):
+                    return None
+            except BaseException:
+                # don't let the next JAR's commit, or the commit on close after SIGTERM or Ctrl-C,
+                # pick up a partially ingested one
+                self.db.rollback()
+                raise
+
+            self.db.commit()
+            self.previewer.update_previews(jar)
+
+            return jar.title
+
+    def write_title_page(self, title):
+        write_title_page(
+            self.db, self.workdir, title, self.stats, previews_db=self.previewer.previews_db, dedup=self.dedup
+        )
+
+    def regenerate_pages(self, titles):
+        for title in sorted(titles):
+            self.write_title_page(title)
+
+        write_index(self.db, self.workdir, self.stats)
+
+    def run(self, paths):
+        pending_title = None
+
+        for path in paths:
+            title = self.process_jar(path)
+
+            if title is None:
+                continue
+
+            # a title page only needs to be written once all of its JARs went through; they are
+            # usually passed grouped by title, so flush whenever the title changes
+            if pending_title is not None and title != pending_title:
+                self.write_title_page(pending_title)
+
+            pending_title = title
+
+        if pending_title is not None:
+            self.write_title_page(pending_title)
+
+        write_index(self.db, self.workdir, self.stats)
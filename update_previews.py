@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import argparse
-import hashlib
 import io
 import os
 from pathlib import Path
@@ -9,11 +8,13 @@ import shutil
 import subprocess
 import sys
 from tempfile import NamedTemporaryFile
-import zipfile
 
 from PIL import Image
 
+from archive import MEMBER_READ_ERRORS, Jar, add_limit_arguments, limits_from_args, reject_member
 from db import DB, PreviewsDB, bad_resource_sha1s
+import instrumentation
+from phash import BITS, BKTree, from_hex, phash, pixel_difference, signature, to_hex
 
 sys.path.insert(0, "tools")
 import fishlabs_obfuscation
@@ -26,198 +27,390 @@ VERSION = 6
 # v5: add model orientation information in DB
 # v6: nearest-neighbor texture interpolation, no specular highlights
 
-parser = argparse.ArgumentParser()
-parser.add_argument("db")
-parser.add_argument("workdir", type=Path)
-parser.add_argument("--resource")
-parser.add_argument("jars", nargs="+", type=Path)
-
-args = parser.parse_args()
-
 rel_full_dir = Path("full")
 rel_thumbs_dir = Path("thumbs")
 
-workdir = args.workdir
-workdir.mkdir(exist_ok=True)
-(workdir / rel_full_dir).mkdir(exist_ok=True)
-(workdir / rel_thumbs_dir).mkdir(exist_ok=True)
-
-db = DB(args.db)
-previews_db = PreviewsDB(workdir / "previews.sqlite")
+THUMB_RESOLUTION = (256, 144)
+FULL_RESOLUTION = (1280, 720)
 
+# maximum Hamming distance (out of phash.BITS) between perceptual hashes of near-duplicate images
+PHASH_DISTANCE = 8
 
-def file_hash(path):
-    h = hashlib.sha1()
+# raised by PIL for unidentified, truncated or corrupt images (UnidentifiedImageError is an OSError)
+IMAGE_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
 
-    with open(path, "rb", buffering=0) as f:
-        for b in iter(lambda: f.read(128 * 1024), b""):
-            h.update(b)
+# maximum mean pixel difference (0..1) confirming a near-duplicate found by perceptual hash
+PIXEL_TOLERANCE = 0.02
 
-    return h.hexdigest()
 
+class Previewer:
+    def __init__(self, db, workdir, stats, resource=None, phash_distance=PHASH_DISTANCE):
+        self.db = db
+        self.workdir = workdir
+        self.stats = stats
+        self.resource = resource
+        self.phash_distance = phash_distance
 
-def stream_hash(f):
-    h = hashlib.sha1()
+        workdir.mkdir(exist_ok=True)
+        (workdir / rel_full_dir).mkdir(exist_ok=True)
+        (workdir / rel_thumbs_dir).mkdir(exist_ok=True)
 
-    for b in iter(lambda: f.read(128 * 1024), b""):
-        h.update(b)
+        self.previews_db = PreviewsDB(workdir / "previews.sqlite", stats=stats)
 
-    return h.hexdigest()
+        # hashes computed by an earlier version of phash() aren't comparable; rehash those images
+        self.previews_db.discard_image_phashes(length=BITS // 4)
 
+        # canonical images by dimensions; near-duplicates must match in size to share a preview
+        self.phash_trees = dict()
 
-def render_mbac(title, path, mbac_data: bytes, sha1, jar_sha1, rel_output_path, is_thumb, resolution):
-    texture_sha1 = db.find_texture_sha1_for_model(title, jar_sha1, path)
+        for row in self.previews_db.canonical_image_phashes():
+            self.add_canonical_image(from_hex(row["phash"]), (row["width"], row["height"]), row["sha1"])
 
-    if texture_sha1 is not None:
-        # TODO: eventually db.find_texture_filename_for_model after previewsDB populated
-        texture_path = workdir / rel_full_dir / f"{texture_sha1}.png"
-    else:
-        texture_path = None
+    def close(self):
+        self.previews_db.close()
 
-    # TODO: search by exact resolution instead
-    record = previews_db.get_mbac_preview(sha1, is_thumb)
+    def add_canonical_image(self, h, size, sha1):
+        try:
+            tree = self.phash_trees[size]
+        except KeyError:
+            tree = self.phash_trees[size] = BKTree()
 
-    axis_forward, axis_up = db.find_default_model_orientation_for_title(title)
-    if axis_forward is None:
-        axis_forward = "-Z"
-    if axis_up is None:
-        axis_up = "Y"
+        tree.add(h, sha1)
 
-    output_path = workdir / rel_output_path
+    def find_canonical_image(self, h, size, image):
+        if self.phash_distance is None or size not in self.phash_trees:
+            return None
 
-    if (
-        record
-        and record["version"] >= MIN_VERSION
-        and record["texture_sha1"] == texture_sha1
-        and record["axis_forward"] == axis_forward
-        and record["axis_up"] == axis_up
-        and output_path.is_file()
-    ):
-        print("UP-TO-DATE", rel_output_path)
-        return
+        image_signature = None
 
-    with NamedTemporaryFile(delete=False, suffix=".mbac") as mbacfile:
-        mbacfile.write(mbac_data)
-
-    print(
-        f"RENDER title={title} path={path} {resolution=} {is_thumb=} texture_path={texture_path} {axis_forward=} {axis_up=}"
-    )
-
-    with NamedTemporaryFile(mode="wt", suffix=".obj", delete=False) as objfile:
-        MBAC_to_obj(f=io.BytesIO(mbac_data), obj=objfile)
+        for d, sha1 in self.phash_trees[size].find(h, self.phash_distance):
+            if not self.has_image_preview(sha1):
+                continue
 
-    with NamedTemporaryFile() as imagefile:
-        render_obj(
-            objfile.name,
-            imagefile.name,     # blender will add its own suffix, see below
-            texture=texture_path,
-            texture_interpolation="Closest",
+            if image_signature is None:
+                image_signature = signature(image)
+
+            with Image.open(self.workdir / rel_full_dir / (sha1 + ".png")) as candidate:
+                if pixel_difference(image_signature, signature(candidate)) <= PIXEL_TOLERANCE:
+                    return sha1
+
+            self.stats.count("image_near_duplicates_rejected")
+
+        return None
+
+    def check_member(self, jar, info, rejected):
+        # members rejected during ingest (e.g. for their pixel count) are skipped as well
+        if info.filename in rejected:
+            self.stats.count("members_skipped")
+            return False
+
+        reason = jar.limits.check_member(info)
+        if reason is not None:
+            reject_member(self.db, jar, info, reason, self.stats)
+            return False
+
+        return True
+
+    def has_image_preview(self, sha1):
+        return (self.workdir / rel_thumbs_dir / (sha1 + ".png")).is_file() and (
+            self.workdir / rel_full_dir / (sha1 + ".png")
+        ).is_file()
+
+    def extract_texture(self, jar, filename):
+        # near-duplicate textures have no preview file of their own; the model must still be
+        # rendered with its exact texture, not the canonical image of its cluster
+        data = fishlabs_obfuscation.normalize(jar.read(filename), Path(filename).suffix.upper())
+
+        with Image.open(io.BytesIO(data)) as image, NamedTemporaryFile(delete=False, suffix=".png") as texturefile:
+            image.save(texturefile, format="PNG")
+
+        return Path(texturefile.name)
+
+    def render_mbac(self, jar, path, mbac_data: bytes, sha1, rel_output_path, is_thumb, resolution):
+        db, stats, workdir = self.db, self.stats, self.workdir
+        title = jar.title
+
+        texture_sha1 = db.find_texture_sha1_for_model(title, jar.sha1, path)
+        extracted_texture_path = None
+
+        if texture_sha1 is not None:
+            texture_path = workdir / rel_full_dir / f"{texture_sha1}.png"
+        else:
+            texture_path = None
+
+        # TODO: search by exact resolution instead
+        record = self.previews_db.get_mbac_preview(sha1, is_thumb)
+
+        axis_forward, axis_up = db.find_default_model_orientation_for_title(title)
+        if axis_forward is None:
+            axis_forward = "-Z"
+        if axis_up is None:
+            axis_up = "Y"
+
+        output_path = workdir / rel_output_path
+
+        if (
+            record
+            and record["version"] >= MIN_VERSION
+            and record["texture_sha1"] == texture_sha1
+            and record["axis_forward"] == axis_forward
+            and record["axis_up"] == axis_up
+            and output_path.is_file()
+        ):
+            stats.count("render_cache_hits")
+            stats.event("up_to_date", "UP-TO-DATE", rel_output_path, output=str(rel_output_path))
+            return
+
+        stats.count("render_cache_misses")
+
+        if texture_path is not None and not texture_path.is_file():
+            try:
+                texture_path = extracted_texture_path = self.extract_texture(
+                    jar, db.find_texture_path_for_model(title, path)
+                )
+            except MEMBER_READ_ERRORS + IMAGE_ERRORS as ex:
+                # the texture itself was rejected; render the bare model
+                stats.event("warning", "warning: unreadable texture for", path, repr(ex), file=sys.stderr, error=repr(ex))
+                texture_path = None
+
+        with NamedTemporaryFile(delete=False, suffix=".mbac") as mbacfile:
+            mbacfile.write(mbac_data)
+
+        stats.event(
+            "render",
+            f"RENDER title={title} path={path} {resolution=} {is_thumb=} texture_path={texture_path} {axis_forward=} {axis_up=}",
+            title=title,
+            path=path,
             resolution=resolution,
+            thumb=is_thumb,
+            texture_path=texture_path,
             axis_forward=axis_forward,
             axis_up=axis_up,
         )
 
-        shutil.move(f"{imagefile.name}0000.png", output_path)
-        os.unlink(objfile.name)
-
-    previews_db.add_mbac_preview(
-        sha1=sha1,
-        thumb=is_thumb,
-        filename=str(rel_output_path),
-        width=resolution[0],
-        height=resolution[1],
-        version=VERSION,
-        texture_sha1=texture_sha1,
-        axis_forward=axis_forward,
-        axis_up=axis_up,
-    )
+        with stats.stage("mbac_to_obj"), NamedTemporaryFile(mode="wt", suffix=".obj", delete=False) as objfile:
+            MBAC_to_obj(f=io.BytesIO(mbac_data), obj=objfile)
+
+        with stats.stage("render_obj"), NamedTemporaryFile() as imagefile:
+            render_obj(
+                objfile.name,
+                imagefile.name,     # blender will add its own suffix, see below
+                texture=texture_path,
+                texture_interpolation="Closest",
+                resolution=resolution,
+                axis_forward=axis_forward,
+                axis_up=axis_up,
+            )
+
+            shutil.move(f"{imagefile.name}0000.png", output_path)
+            os.unlink(objfile.name)
+
+        if extracted_texture_path is not None:
+            os.unlink(extracted_texture_path)
+
+        stats.count("renders_done")
+
+        self.previews_db.add_mbac_preview(
+            sha1=sha1,
+            thumb=is_thumb,
+            filename=str(rel_output_path),
+            width=resolution[0],
+            height=resolution[1],
+            version=VERSION,
+            texture_sha1=texture_sha1,
+            axis_forward=axis_forward,
+            axis_up=axis_up,
+        )
 
+    def update_image_previews(self, jar):
+        stats, workdir = self.stats, self.workdir
+
+        with stats.stage("image_previews"):
+            rejected = self.db.rejected_members(jar.sha1)
+
+            for info in jar.infolist():
+                ext = Path(info.filename).suffix.upper()
+
+                if ext == ".BMP" or ext == ".PNG":
+                    stats.count("members_probed")
+
+                    if not self.check_member(jar, info, rejected):
+                        continue
+
+                    try:
+                        sha1 = jar.member_sha1(info.filename)
+                    except MEMBER_READ_ERRORS as ex:
+                        reject_member(self.db, jar, info, f"unreadable: {ex!r}", stats)
+                        continue
+
+                    record = self.previews_db.get_image_phash(sha1)
+
+                    # without dedup, images clustered by an earlier run get a preview of their own
+                    if (
+                        record is not None
+                        and self.has_image_preview(record["canonical_sha1"])
+                        and (self.phash_distance is not None or record["canonical_sha1"] == sha1)
+                    ):
+                        stats.count("image_cache_hits")
+                        continue
+
+                    stats.count("image_cache_misses")
+
+                    try:
+                        data = fishlabs_obfuscation.normalize(jar.read(info.filename), ext)
+                        image = Image.open(io.BytesIO(data))
+                    except MEMBER_READ_ERRORS + IMAGE_ERRORS as ex:
+                        reject_member(self.db, jar, info, f"unreadable: {ex!r}", stats)
+                        continue
+
+                    width, height = image.size
+
+                    # check before anything decodes the pixel data
+                    reason = jar.limits.check_image(image.size)
+                    if reason is not None:
+                        reject_member(self.db, jar, info, reason, stats)
+                        continue
+
+                    try:
+                        # Image.open() is lazy; truncated or corrupt pixel data only shows up here
+                        image.load()
+
+                        with stats.stage("phash"):
+                            h = phash(image)
+                    except IMAGE_ERRORS as ex:
+                        reject_member(self.db, jar, info, f"undecodable: {ex!r}", stats)
+                        continue
+
+                    canonical_sha1 = self.find_canonical_image(h, (width, height), image)
+
+                    if canonical_sha1 is not None:
+                        stats.count("image_near_duplicates")
+                        stats.event(
+                            "near_duplicate",
+                            "NEAR-DUPLICATE",
+                            info.filename,
+                            sha1,
+                            canonical_sha1,
+                            jar=str(jar.path),
+                            member=info.filename,
+                            sha1=sha1,
+                            canonical_sha1=canonical_sha1,
+                        )
+                    else:
+                        canonical_sha1 = sha1
+
+                        if not self.has_image_preview(sha1):
+                            stats.event(
+                                "preview", "PREVIEW", info, data[-8:], jar=str(jar.path), member=info.filename, sha1=sha1
+                            )
+
+                            try:
+                                image.save(workdir / rel_full_dir / (sha1 + ".png"))
+                                image.thumbnail(THUMB_RESOLUTION)
+                                image.save(workdir / rel_thumbs_dir / (sha1 + ".png"))
+                            except IMAGE_ERRORS as ex:
+                                # e.g. a mode PNG can't store; don't leave a half-written preview behind
+                                for rel_dir in [rel_full_dir, rel_thumbs_dir]:
+                                    (workdir / rel_dir / (sha1 + ".png")).unlink(missing_ok=True)
+
+                                reject_member(self.db, jar, info, f"unsaveable: {ex!r}", stats)
+                                continue
+
+                        self.add_canonical_image(h, (width, height), sha1)
+
+                    self.previews_db.add_image_phash(
+                        sha1=sha1,
+                        phash=to_hex(h),
+                        width=width,
+                        height=height,
+                        canonical_sha1=canonical_sha1,
+                    )
 
-# images first to ensure we have textures
-for path in args.jars:
-    with zipfile.ZipFile(path, mode="r") as z:
-        for info in z.infolist():
-            ext = Path(info.filename).suffix.upper()
+    def update_model_previews(self, jar, is_thumb):
+        if is_thumb:
+            stage, rel_dir, resolution = "thumbnail_renders", rel_thumbs_dir, THUMB_RESOLUTION
+        else:
+            stage, rel_dir, resolution = "full_renders", rel_full_dir, FULL_RESOLUTION
 
-            if ext == ".BMP" or ext == ".PNG":
-                with z.open(info.filename, "r") as f:
-                    data = f.read()
-                    f.seek(0)
-                    sha1 = stream_hash(f)
+        with self.stats.stage(stage):
+            rejected = self.db.rejected_members(jar.sha1)
 
-                if (workdir / rel_thumbs_dir / (sha1 + ".png")).is_file() and (
-                    workdir / rel_full_dir / (sha1 + ".png")
-                ).is_file():
+            for info in jar.infolist():
+                if self.resource and info.filename != self.resource:
                     continue
 
-                data = fishlabs_obfuscation.normalize(data, ext)
+                ext = Path(info.filename).suffix.upper()
+
+                if ext == ".MBAC":
+                    if not self.check_member(jar, info, rejected):
+                        continue
+
+                    try:
+                        mbac, sha1 = jar.read_with_sha1(info.filename)
+                    except MEMBER_READ_ERRORS as ex:
+                        reject_member(self.db, jar, info, f"unreadable: {ex!r}", self.stats)
+                        continue
+
+                    if sha1 not in bad_resource_sha1s:
+                        mbac = fishlabs_obfuscation.normalize(mbac, ext)
+                        self.render_mbac(
+                            jar,
+                            info.filename,
+                            mbac,
+                            sha1,
+                            rel_dir / (sha1 + ".png"),
+                            is_thumb=is_thumb,
+                            resolution=resolution,
+                        )
+
+    def update_previews(self, jar):
+        # images first to ensure we have textures
+        self.update_image_previews(jar)
+        self.update_model_previews(jar, is_thumb=True)
+        self.update_model_previews(jar, is_thumb=False)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db")
+    parser.add_argument("workdir", type=Path)
+    parser.add_argument("--resource")
+    parser.add_argument(
+        "--phash-distance",
+        type=int,
+        default=PHASH_DISTANCE,
+        help="maximum perceptual hash distance between near-duplicate images sharing a preview",
+    )
+    parser.add_argument("--no-dedup", dest="phash_distance", action="store_const", const=None)
+    parser.add_argument("jars", nargs="+", type=Path)
+    add_limit_arguments(parser)
+    instrumentation.add_arguments(parser)
 
-                print("PREVIEW", info, data[-8:])
-                image = Image.open(io.BytesIO(data))
-                image.save(workdir / rel_full_dir / (sha1 + ".png"))
-                image.thumbnail((256, 144))
-                image.save(workdir / rel_thumbs_dir / (sha1 + ".png"))
+    args = parser.parse_args()
 
-# previews
+    stats = instrumentation.from_args(args)
+    db = DB(args.db, stats=stats)
+    previewer = Previewer(db, args.workdir, stats, resource=args.resource, phash_distance=args.phash_distance)
 
-for path in args.jars:
-    title = path.parent.name
-    jar_hash = file_hash(path)
+    limits = limits_from_args(args)
 
-    with zipfile.ZipFile(path, mode="r") as z:
-        for info in z.infolist():
-            if args.resource and info.filename != args.resource:
-                continue
+    # images first to ensure we have textures, then all thumbnails before any full-size renders;
+    # archives are opened one at a time to stay within the open file limit on large collections
+    for path in args.jars:
+        with Jar(path, stats=stats, limits=limits) as jar:
+            previewer.update_image_previews(jar)
 
-            ext = Path(info.filename).suffix.upper()
-
-            if ext == ".MBAC":
-                with z.open(info.filename, "r") as f:
-                    mbac = f.read()
-                    f.seek(0)
-                    sha1 = stream_hash(f)
-
-                if sha1 not in bad_resource_sha1s:
-                    mbac = fishlabs_obfuscation.normalize(mbac, ext)
-                    render_mbac(
-                        title,
-                        info.filename,
-                        mbac,
-                        sha1,
-                        jar_hash,
-                        rel_thumbs_dir / (sha1 + ".png"),
-                        is_thumb=True,
-                        resolution=(256, 144),
-                    )
+    for path in args.jars:
+        with Jar(path, stats=stats, limits=limits) as jar:
+            previewer.update_model_previews(jar, is_thumb=True)
 
-# full-size renders
+    for path in args.jars:
+        with Jar(path, stats=stats, limits=limits) as jar:
+            previewer.update_model_previews(jar, is_thumb=False)
 
-for path in args.jars:
-    title = path.parent.name
-    jar_hash = file_hash(path)
+    previewer.close()
+    db.close()
 
-    with zipfile.ZipFile(path, mode="r") as z:
-        for info in z.infolist():
-            if args.resource and info.filename != args.resource:
-                continue
 
-            ext = Path(info.filename).suffix.upper()
-
-            if ext == ".MBAC":
-                with z.open(info.filename, "r") as f:
-                    mbac = f.read()
-                    f.seek(0)
-                    sha1 = stream_hash(f)
-
-                if sha1 not in bad_resource_sha1s:
-                    mbac = fishlabs_obfuscation.normalize(mbac, ext)
-                    render_mbac(
-                        title,
-                        info.filename,
-                        mbac,
-                        sha1,
-                        jar_hash,
-                        rel_full_dir / (sha1 + ".png"),
-                        is_thumb=False,
-                        resolution=(1280, 720),
-                    )
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+from pathlib import Path
+import select
+import struct
+import sys
+import time
+
+from db import QueueDB
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_Q_OVERFLOW = 0x00004000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o0004000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+MAX_FAILURES = 3
+
+# seconds before the first retry of a failed JAR, doubled on each further failure
+RETRY_DELAY = 60
+
+
+class Inotify:
+    # Minimal inotify(7) binding; avoids pulling in a dependency for three syscalls
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        self.paths_by_wd = dict()
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), str(path))
+
+        self.paths_by_wd[wd] = Path(path)
+
+    def read_events(self, timeout):
+        # yields (directory, name, mask)
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+
+        buf = os.read(self.fd, 64 * 1024)
+        pos = 0
+
+        while pos < len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(buf[pos : pos + length].rstrip(b"\0"))
+            pos += length
+
+            if mask & IN_IGNORED:
+                self.paths_by_wd.pop(wd, None)
+                continue
+
+            yield self.paths_by_wd.get(wd), name, mask
+
+
+class Watcher:
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, pipeline, root, queue_path, stats, debounce):
+        self.pipeline = pipeline
+        self.root = Path(root)
+        self.stats = stats
+        self.debounce = debounce
+
+        self.queue = QueueDB(queue_path)
+        self.inotify = Inotify()
+
+    def close(self):
+        self.inotify.close()
+        self.queue.close()
+
+    def enqueue(self, path):
+        self.stats.count("watch_events")
+        self.queue.enqueue(path, time.time())
+
+    def vanished(self, path, ex):
+        self.stats.count("watch_vanished")
+        self.stats.event("vanished", "VANISHED", path, repr(ex), file=sys.stderr, path=str(path), error=repr(ex))
+
+    def watch_dir(self, path):
+        # returns False if the directory was renamed or removed before it could be watched
+        try:
+            self.inotify.add_watch(path, self.WATCH_MASK)
+        except OSError as ex:
+            if ex.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+
+            self.vanished(path, ex)
+            return False
+
+        return True
+
+    def watch_tree(self):
+        # archives live at <root>/<title>/<file>.jar; watching an already watched directory again
+        # only refreshes its watch
+        self.watch_dir(self.root)
+
+        for child in self.root.iterdir():
+            if child.is_dir():
+                self.watch_dir(child)
+
+    def scan(self):
+        # pick up JARs that arrived while the watcher was not running
+        for path in sorted(self.root.glob("*/*.jar")):
+            try:
+                size = path.stat().st_size
+            except FileNotFoundError as ex:
+                self.vanished(path, ex)
+                continue
+
+            if not self.pipeline.db.has_jar(path.parent.name, path.name, size):
+                self.enqueue(path)
+
+    def handle_event(self, directory, name, mask):
+        if directory is None:
+            return
+
+        path = directory / name
+
+        if mask & IN_ISDIR:
+            # a new title directory; JARs may have been moved in together with it
+            if directory == self.root and self.watch_dir(path):
+                for jar_path in sorted(path.glob("*.jar")):
+                    self.enqueue(jar_path)
+        elif directory != self.root and path.suffix.lower() == ".jar" and mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.enqueue(path)
+
+    def process_ready(self):
+        titles = set()
+
+        for row in self.queue.ready(time.time() - self.debounce, MAX_FAILURES):
+            path = Path(row["path"])
+
+            if not path.is_file():
+                self.queue.done(row)
+                continue
+
+            try:
+                with self.stats.stage("watch_jar"):
+                    title = self.pipeline.process_jar(path)
+            except Exception as ex:
+                self.stats.count("watch_failures")
+                self.stats.event("watch_failure", "FAILED", path, repr(ex), file=sys.stderr, path=str(path), error=repr(ex))
+                self.pipeline.db.rollback()
+                self.queue.failed(row, time.time() + RETRY_DELAY * 2 ** row["failures"])
+                continue
+
+            if title is not None:
+                titles.add(title)
+
+            self.queue.done(row)
+
+        if titles:
+            self.pipeline.regenerate_pages(titles)
+            self.stats.event("pages_updated", "PAGES", *sorted(titles), titles=sorted(titles))
+
+    def run(self, scan=False):
+        self.watch_tree()
+
+        if scan:
+            self.scan()
+
+        # process anything left over from a previous run straight away
+        while True:
+            self.process_ready()
+
+            deadline = self.queue.next_deadline(MAX_FAILURES)
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, deadline + self.debounce - time.time())
+
+            for directory, name, mask in self.inotify.read_events(timeout):
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, including possibly new title directories; watch and rescan
+                    self.watch_tree()
+                    self.scan()
+                else:
+                    self.handle_event(directory, name, mask)